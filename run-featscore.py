@@ -65,16 +65,18 @@ class Lock:
     def acquire(self):
         if args.disable_locking:
             return
-        self.file = open(self.filename, 'w')
-        self.file = open(self.filename, 'w')
-        print(os.getpid(), file=self.file)
-        fcntl.flock(self.file, fcntl.LOCK_EX)
+        # Open without truncating so we don't wipe the holder's pid while we wait.
+        # lockf gives POSIX record locks, which work over NFS where flock may not.
+        self.file = open(self.filename, 'a')
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        self.file.truncate(0)
+        print(os.getpid(), file=self.file, flush=True)
     
     def release(self):
         if args.disable_locking:
             return
         if self.file:
-            fcntl.flock(self.file, fcntl.LOCK_UN)
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
             self.file.close()
             self.file = None
 
@@ -82,7 +84,7 @@ class Lock:
         self.acquire()
         return self
     
-    def __exit__(self):
+    def __exit__(self, exc_type, exc, tb):
         self.release()
 
 @contextmanager
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3 -u
 
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import json
+import multiprocessing
 import subprocess
 import sys
+import time
 import argparse
 import logging
+import random
 import os
+import uuid
 import fcntl
 
-logging.basicConfig(format='%(levelname)s %(msg)s',
-                    level=logging.DEBUG)
+logging.basicConfig(format='%(levelname)s %(message)s',
+                    level=logging.INFO)
 
 ap = argparse.ArgumentParser(
     description='Run a MyCal experiment with iterative training and testing',
@@ -23,6 +30,14 @@ ap.add_argument('-n', '--num_docs',
                 default=1,
                 type=int,
                 help='Number of documents to score at each round')
+ap.add_argument('-S', '--pool-sample',
+                default=None,
+                type=int,
+                help='Train initially on a uniform sample of this many pool documents, None for all')
+ap.add_argument('--seed',
+                default=None,
+                type=int,
+                help='Random seed for --pool-sample, None to seed from the system')
 ap.add_argument('-s', '--max_steps',
                 default=None,
                 type=int,
@@ -40,13 +55,36 @@ ap.add_argument('-l', '--lockfile',
 ap.add_argument('-L', '--disable-locking',
                 action='store_true',
                 help='Disable collection data lock')
+ap.add_argument('-D', '--daemon',
+                default=None,
+                help='Unix socket for a MyCal daemon (sockcal) to train and score with, None to run MyCal every step')
 ap.add_argument('-d', '--docdb',
                 help='Document database prefix',
                 default='cd45')
+ap.add_argument('-p', '--pipeline',
+                action='store_true',
+                help='Score the next round with the previous model while training (one step stale)')
+ap.add_argument('-v', '--verbose',
+                action='store_true',
+                help='Log debugging output')
+ap.add_argument('-w', '--warm-start',
+                action='store_true',
+                help='Train each step by continuing from the last model instead of from scratch')
+ap.add_argument('-i', '--iterations',
+                default=None,
+                type=int,
+                help='Training iterations for each warm-started step, None for the MyCal default')
 ap.add_argument('-r', '--relstop',
                 help='Stop when all relevant documents are found',
                 action='store_false')
+ap.add_argument('-T', '--topics-file',
+                help='File of topic numbers to run in parallel, instead of a single topic')
+ap.add_argument('-j', '--jobs',
+                default=None,
+                type=int,
+                help='Number of topics to run at once with --topics-file, None for one per CPU')
 ap.add_argument('topic',
+                nargs='?',
                 help='Topic number, used as prefix for all files')
 ap.add_argument('pool',
                 help='Pool to take training data from')
@@ -54,8 +92,15 @@ ap.add_argument('qrels',
                 help='Relevance judgments for training and test')
 
 args = ap.parse_args()
+if args.verbose:
+    logging.getLogger().setLevel(logging.DEBUG)
+if (args.topic is None) == (args.topics_file is None):
+    ap.error('give either a topic or --topics-file')
+if args.pool_sample is not None and args.pool_sample < 1:
+    ap.error('--pool-sample must be at least 1')
 MYCAL = '/Users/soboroff/mycal-project/mycal/target/release/mycal'
 SCORE = '/Users/soboroff/mycal-project/mycal/target/release/score-index'
+SOCKCAL = '/Users/soboroff/mycal-project/mycal/target/release/sockcal'
 
 class Lock:
     def __init__(self, filename):
@@ -65,16 +110,18 @@ class Lock:
     def acquire(self):
         if args.disable_locking:
             return
-        self.file = open(self.filename, 'w')
-        self.file = open(self.filename, 'w')
-        print(os.getpid(), file=self.file)
-        fcntl.flock(self.file, fcntl.LOCK_EX)
+        # Open without truncating so we don't wipe the holder's pid while we wait.
+        # lockf gives POSIX record locks, which work over NFS where flock may not.
+        self.file = open(self.filename, 'a')
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        self.file.truncate(0)
+        print(os.getpid(), file=self.file, flush=True)
     
     def release(self):
         if args.disable_locking:
             return
         if self.file:
-            fcntl.flock(self.file, fcntl.LOCK_UN)
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
             self.file.close()
             self.file = None
 
@@ -82,146 +129,346 @@ class Lock:
         self.acquire()
         return self
     
-    def __exit__(self):
+    def __exit__(self, exc_type, exc, tb):
         self.release()
 
-@contextmanager
-def locked(filename):
-    lock = Lock(filename)
+# Set in worker processes when running a --topics-file, so the
+# topics share an in-memory lock instead of the lockfile
+train_lock = None
+
+@asynccontextmanager
+async def locked(filename):
+    lock = Lock(filename) if train_lock is None else train_lock
     try:
-        lock.acquire()
+        await asyncio.to_thread(lock.acquire)
         yield lock
     finally:
         lock.release()
 
-qrels = {}
-with open(args.qrels, 'r') as qrels_file:
-    for line in qrels_file:
+def topic_lines(filename, topics):
+    # Read the lines of a qrels or pool file for the given topics, as bytes.
+    # Lines for other topics are rejected on their prefix without being split.
+    prefixes = tuple(f'{topic}{sep}'.encode() for topic in topics for sep in ' \t')
+    with open(filename, 'rb') as topic_file:
+        return [line for line in topic_file.read().splitlines() if line.startswith(prefixes)]
+
+def split_qrels(filename, topics):
+    # Read the qrels once for all topics, as {topic: {docid: rel}}.
+    # Docids are interned so that qrels, pool and training data share one string per document
+    qrels = {topic.encode(): {} for topic in topics}
+    for line in topic_lines(filename, topics):
         topic, _, docid, rel = line.split()
-        if topic != args.topic:
-            continue
-        qrels[docid] = int(rel)
-num_rel = sum(1 for v in qrels.values() if v > 0)
+        qrels[topic][sys.intern(docid.decode())] = int(rel)
+    return {topic.decode(): topic_qrels for topic, topic_qrels in qrels.items()}
+
+def split_pool(filename, topics):
+    # Read the pool once for all topics, as {topic: [line]}, so that each
+    # topic only has to be handed its own lines
+    pool = {topic.encode(): [] for topic in topics}
+    for line in topic_lines(filename, topics):
+        pool[line.split(maxsplit=1)[0]].append(line)
+    return {topic.decode(): topic_pool for topic, topic_pool in pool.items()}
+
+def topic_label():
+    # With --topics-file, topics share one stdout, so their lines start with the topic
+    return f'{args.topic} ' if args.topics_file else ''
+
+# Per-topic state, set up by one_topic()
+qrels = {}
+pool = []
+num_rel = 0
 rel_seen = 0
 docs_reviewed = 0
 rel_seen_after_training = 0
+# The training data so far, docid -> rel
+train = {}
+# The daemon's name for this run's exclude set, and the training
+# docids it hasn't been told to exclude yet
+exclude_key = None
+unsent_excludes = []
 
-def do_initial_training():
+async def run_command(*cmd):
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    if await proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def start_daemon():
+    daemon = subprocess.Popen([SOCKCAL, args.docdb, args.daemon])
+    # Wait for the daemon to open the collection and bind its socket
+    while not os.path.exists(args.daemon):
+        if daemon.poll() is not None:
+            logging.critical(f'MyCal daemon exited with status {daemon.returncode}')
+            sys.exit(-1)
+        time.sleep(0.1)
+    return daemon
+
+async def daemon_request(request):
+    # One connection per request, so training and scoring can be in flight together
+    reader, writer = await asyncio.open_unix_connection(args.daemon, limit=2**24)
+    try:
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    response = json.loads(line) if line else {'ok': False, 'error': 'connection closed'}
+    if not response['ok']:
+        logging.critical(f'MyCal daemon failed to {request["op"]}: {response["error"]}')
+        sys.exit(-1)
+    return response
+
+async def train_model(step):
+    warm_start = None
+    if args.warm_start and step > 0:
+        warm_start = f'{args.topic}.model.{step - 1}'
+    async with locked(args.lockfile):
+        if args.daemon:
+            request = {'op': 'train',
+                       'model_file': f'{args.topic}.model.{step}',
+                       'qrels_file': f'{args.topic}.train.{step}'}
+            if warm_start:
+                request['warm_start'] = warm_start
+                if args.iterations:
+                    request['num_iters'] = args.iterations
+            await daemon_request(request)
+            return
+        options = []
+        if warm_start:
+            options += ['--warm-start', warm_start]
+            if args.iterations:
+                options += ['--iterations', str(args.iterations)]
+        await run_command(MYCAL, args.docdb, f'{args.topic}.model.{step}', 'train',
+                          *options, f'{args.topic}.train.{step}')
+
+async def score_collection(step, model_step):
+    # Score with the model from model_step, excluding the training data from the step before.
+    # Results are yielded as score-index prints them.
+    global unsent_excludes
+    if args.daemon:
+        # The daemon keeps this topic's exclude set, so only send what it hasn't seen
+        exclude_docs, unsent_excludes = unsent_excludes, []
+        response = await daemon_request({'op': 'score',
+                                         'model_file': f'{args.topic}.model.{model_step}',
+                                         'num_results': args.num_docs,
+                                         'exclude_key': exclude_key,
+                                         'exclude_docs': exclude_docs})
+        for entry in response['results']:
+            yield sys.intern(entry['docid']), entry['score']
+        return
+    cmd = [SCORE, args.docdb, f'{args.topic}.model.{model_step}',
+           '-n', str(args.num_docs),
+           '-e', f'{args.topic}.train.{step - 1}']
+    proc = await asyncio.create_subprocess_exec(*cmd,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.DEVNULL)
+    try:
+        async for line in proc.stdout:
+            docid, score = line.split()
+            yield sys.intern(docid.decode()), score
+        if await proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    finally:
+        # Don't leave the scorer running if we were cancelled
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+async def prefetch_scores(step, model_step):
+    return [scored async for scored in score_collection(step, model_step)]
+
+async def do_initial_training():
     global rel_seen, docs_reviewed
+    # Reservoir-sample the pool if asked to (Algorithm R).  Each topic gets
+    # its own generator, so a seeded run samples the same way every time.
+    rng = random.Random(args.seed)
+    sample = []
+    num_eligible = 0
+    # Ranks are compared as digit strings rather than converted: a shorter
+    # number is smaller, and numbers of the same length compare bytewise
+    max_rank = str(args.train_rank).encode()
+    max_rank_len = len(max_rank)
+    for line in pool:
+        _, docid, rank, _ = line.split(maxsplit=3)
+        if len(rank) > max_rank_len or (len(rank) == max_rank_len and rank > max_rank):
+            continue
+        num_eligible += 1
+        if args.pool_sample is None or len(sample) < args.pool_sample:
+            sample.append(sys.intern(docid.decode()))
+        else:
+            slot = rng.randrange(num_eligible)
+            if slot < args.pool_sample:
+                sample[slot] = sys.intern(docid.decode())
+
     with open(f'{args.topic}.train.0', 'w') as train_file:
-        with open(args.pool, 'r') as pool_file:
-            for line in pool_file:
-                topic, docid, rank, _ = line.split(maxsplit=3)
-                if topic != args.topic:
-                    continue
-                if int(rank) > args.train_rank:
-                    continue
-                docs_reviewed += 1
-                if docid in qrels:
-                    rel = qrels[docid]
-                    if rel > 0:
-                        rel_seen += 1
-                else:
-                    rel = 0
-                print(f'{topic} 0 {docid} {rel}', file=train_file)
-
-    with locked(args.lockfile):
-        subprocess.run([ MYCAL, args.docdb, f'{args.topic}.model.0', 'train', 
-                        f'{args.topic}.train.0' ], check=True),
-    print(f'Initial: {docs_reviewed} reviewed, {rel_seen} relevant out of {num_rel} total')
+        for docid in sample:
+            docs_reviewed += 1
+            rel = qrels.get(docid, 0)
+            if rel > 0:
+                rel_seen += 1
+            train[docid] = rel
+            print(f'{args.topic} 0 {docid} {rel}', file=train_file)
+    if args.daemon:
+        unsent_excludes.extend(sample)
+
+    await train_model(0)
+    print(f'{topic_label()}Initial: {docs_reviewed} reviewed, {rel_seen} relevant out of {num_rel} total')
 
 zero_steps = 0
 sum_prec = 0.0
+next_scores = None
 
-def one_step(step):
-    global rel_seen, docs_reviewed, zero_steps, rel_seen_after_training
+async def one_step(step):
+    global rel_seen, docs_reviewed, zero_steps, rel_seen_after_training, next_scores
     last_step = step - 1
     if last_step < 0:
         logging.critical(f'Bad step value {step}')
         sys.exit(-1)
 
-    # get last training data
-    train = {}
-    with open(f'{args.topic}.train.{last_step}', 'r') as train_file:
-        for line in train_file:
-            topic, _, docid, rel = line.split()
-            if topic != args.topic:
-                logging.critical('Bad training file, wrong topic')
+    # Score collection, unless the last step already did it
+    if next_scores is None:
+        docids = [docid async for docid, score in score_collection(step, last_step)]
+    else:
+        docids, next_scores = [docid for docid, score in await next_scores], None
+
+    # Add judgments to training data, a whole batch at a time.  A docid
+    # repeated within the batch is as bad as one already trained on.
+    if len(set(docids)) != len(docids) or not train.keys().isdisjoint(docids):
+        seen = set()
+        for docid in docids:
+            if docid in train or docid in seen:
+                logging.critical(f'Scored document {docid} already in training data')
                 sys.exit(-1)
-            train[docid] = rel
-        
-    # Score collection
-    result = subprocess.run([ SCORE, args.docdb, f'{args.topic}.model.{last_step}', 
-                             '-n', str(args.num_docs), 
-                             '-e', f'{args.topic}.train.{last_step}'], check=True, capture_output=True)
-
-    # Add judgments to training data
-    rel_seen_this_step = 0
-    for line in result.stdout.splitlines():
-        docid, score = line.decode('utf-8').split()
-        if docid in train:
-            logging.critical(f'Scored document {docid} already in training data')
-            sys.exit(-1)
-        docs_reviewed += 1
-        if docid in qrels:
-            rel = qrels[docid]
-            if rel > 0:
-                rel_seen += 1
-                rel_seen_this_step += 1
-                rel_seen_after_training += 1
-                zero_steps = 0
-        else:
-            rel = 0
-        logging.debug(f'Adding {docid} to training')
-        train[docid] = rel
-        
-    if rel_seen_this_step == 0:
+            seen.add(docid)
+    # Most scored documents are unjudged, so look them up with a single probe
+    rels = [qrels.get(docid, 0) for docid in docids]
+    rel_seen_this_step = sum(1 for rel in rels if rel > 0)
+    docs_reviewed += len(docids)
+    rel_seen += rel_seen_this_step
+    rel_seen_after_training += rel_seen_this_step
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Adding %s to training', ' '.join(docids))
+    train.update(zip(docids, rels))
+    if args.daemon:
+        unsent_excludes.extend(docids)
+
+    if rel_seen_this_step > 0:
+        zero_steps = 0
+    else:
         zero_steps += 1
         
     # Write new training data
     with open(f'{args.topic}.train.{step}', 'w') as train_file:
-        for docid, rel in train.items():
-            print(args.topic, 0, docid, rel, file=train_file)
+        train_file.writelines([f'{args.topic} 0 {docid} {rel}\n' for docid, rel in train.items()])
 
-    # Train new model
-    with locked(args.lockfile):
-        subprocess.run( [MYCAL, args.docdb, f'{args.topic}.model.{step}', 'train', 
-                    f'{args.topic}.train.{step}' ], check=True)
+    # Train new model.  When pipelining, score the next step with the last
+    # model while this one trains.  Those scores are at most one step stale:
+    # step + 1 is chosen by model last_step, without this step's judgments.
+    # The scoring task carries on past the end of this step and is awaited
+    # at the start of the next one.
+    if args.pipeline:
+        next_scores = asyncio.create_task(prefetch_scores(step + 1, last_step))
+    await train_model(step)
 
     print(f'{args.topic} Step {step}: {docs_reviewed} reviewed, {rel_seen} relevant / {num_rel} total, {rel_seen_after_training / step:.4f} step set prec')
     return rel_seen_this_step
 
-if __name__ == '__main__':
+async def run_topic():
+    global sum_prec
     step = 0
-    do_initial_training()
+    await do_initial_training()
     sum_prec += rel_seen / docs_reviewed
-    print(f'AP: {sum_prec / num_rel:.4f}')
+    print(f'{topic_label()}AP: {sum_prec / num_rel:.4f}')
     
-    if not args.max_steps:
-        args.max_steps = len(qrels)
+    max_steps = args.max_steps or len(qrels)
     
     while True:
         step += 1
-        new_rel = one_step(step)
+        new_rel = await one_step(step)
         if new_rel > 0:
             sum_prec += rel_seen / docs_reviewed
-        print(f'AP: {sum_prec / num_rel:.4f}')
+        print(f'{topic_label()}AP: {sum_prec / num_rel:.4f}')
         
         if args.relstop and rel_seen >= num_rel:
-            logging.info('Found all relevant, stopping')
+            logging.info(f'{topic_label()}Found all relevant, stopping')
             break
-        if args.max_steps and step >= args.max_steps:
-            logging.info('Maximum steps, stopping')
+        if max_steps and step >= max_steps:
+            logging.info(f'{topic_label()}Maximum steps, stopping')
             break
         if args.fail_out and docs_reviewed > 300 and float(rel_seen)/docs_reviewed > 0.5:
-            logging.info(f'Stop criterion met: seen > 300, rel > 0.5; drop topic')
+            logging.info(f'{topic_label()}Stop criterion met: seen > 300, rel > 0.5; drop topic')
             break
         if args.fail_out and docs_reviewed > 150 and new_rel > 3 and float(rel_seen)/docs_reviewed > 0.4:
             # can't happen when we are running one doc at a time.
-            logging.info(f'Stop criterion met: seen > 150, rel < 0.4; keep topic')
+            logging.info(f'{topic_label()}Stop criterion met: seen > 150, rel < 0.4; keep topic')
             break
         if args.zero_steps and zero_steps > args.zero_steps:
-            logging.info(f'{zero_steps} steps with no new relevant found, stopping')
+            logging.info(f'{topic_label()}{zero_steps} steps with no new relevant found, stopping')
             break
-        
-        
+
+    if next_scores is not None:
+        if args.daemon:
+            # Let the last score finish with the exclude set before it's dropped
+            await next_scores
+        else:
+            next_scores.cancel()
+    if args.daemon:
+        await daemon_request({'op': 'forget', 'exclude_key': exclude_key})
+    return sum_prec / num_rel
+
+def one_topic(topic, topic_qrels, topic_pool):
+    # Run a whole topic from scratch and return its AP
+    global qrels, pool, num_rel, rel_seen, docs_reviewed, rel_seen_after_training, train
+    global exclude_key, unsent_excludes, zero_steps, sum_prec, next_scores
+    args.topic = topic
+    qrels = topic_qrels
+    pool = topic_pool
+    num_rel = sum(1 for v in qrels.values() if v > 0)
+    rel_seen = 0
+    docs_reviewed = 0
+    rel_seen_after_training = 0
+    train = {}
+    # A fresh key per run, so a topic run twice never inherits an earlier run's excludes
+    exclude_key = f'{topic}.{uuid.uuid4().hex}'
+    unsent_excludes = []
+    zero_steps = 0
+    sum_prec = 0.0
+    next_scores = None
+    return asyncio.run(run_topic())
+
+def init_worker(lock):
+    global train_lock
+    train_lock = lock
+
+def main():
+    if args.topics_file:
+        with open(args.topics_file, 'r') as topics_file:
+            # A topic listed twice would have two workers sharing its train and model files
+            topics = list(dict.fromkeys(topics_file.read().split()))
+        all_qrels = split_qrels(args.qrels, topics)
+        all_pools = split_pool(args.pool, topics)
+        lock = None if args.disable_locking else multiprocessing.Lock()
+        with ProcessPoolExecutor(max_workers=args.jobs,
+                                 initializer=init_worker, initargs=(lock,)) as executor:
+            runs = [(topic, executor.submit(one_topic, topic, all_qrels[topic], all_pools[topic]))
+                    for topic in topics]
+            for topic, run in runs:
+                print(f'{topic} final AP: {run.result():.4f}')
+    else:
+        one_topic(args.topic, split_qrels(args.qrels, [args.topic])[args.topic],
+                  split_pool(args.pool, [args.topic])[args.topic])
+
+if __name__ == '__main__':
+    if args.daemon:
+        if os.path.exists(args.daemon):
+            os.remove(args.daemon)
+        daemon = start_daemon()
+        try:
+            main()
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            if os.path.exists(args.daemon):
+                os.remove(args.daemon)
+    else:
+        main()
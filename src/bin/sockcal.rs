@@ -0,0 +1,263 @@
+use clap::Parser;
+use log::{debug, error};
+use mycal::classifier::train_qrels;
+use mycal::{index, Classifier, Store};
+use serde::Deserialize;
+use serde_json::{json, Value};
+use std::collections::{HashMap, HashSet};
+use std::error::Error;
+use std::fs::File;
+use std::io::{BufRead, BufReader, BufWriter, Write};
+use std::os::unix::net::{UnixListener, UnixStream};
+use std::sync::{Arc, Condvar, Mutex, MutexGuard};
+use std::thread;
+
+// A local version of webcal that listens on a Unix domain socket.
+// Each request is one line of JSON, tagged with "op", and gets one line
+// of JSON back: {"ok": true, ...} or {"ok": false, "error": "..."}.
+// The collection stays open between requests, so clients avoid starting
+// a new process and reloading the Store at every step.
+//
+// Requests run at the same time: each one checks out a Store of its own
+// from a pool of idle ones, and a new Store is opened only when all of
+// them are busy.  So a client can score with one model while it trains
+// the next, and several clients can share one daemon.  Every Store loads
+// its own docid hash, fv offsets and idf table, so the pool is capped at
+// --max-stores (4 by default); past that, requests wait for a free one.
+//
+// A client that scores over and over against a growing exclude set can
+// name it with exclude_key and send only the docids it has added since
+// its last request in exclude_docs.  The daemon keeps each named set as
+// internal docids, so it is neither re-sent nor re-parsed at every step.
+// A "forget" request drops the set when the client is done with it.
+
+#[derive(Parser)]
+struct Cli {
+    coll_prefix: String,
+    socket: String,
+    #[arg(short, long)]
+    max_stores: Option<usize>,
+}
+
+#[derive(Deserialize)]
+struct TrainArgs {
+    model_file: String,
+    qrels_file: String,
+    rel_level: Option<i32>,
+    sample_neg: Option<usize>,
+    warm_start: Option<String>,
+    num_iters: Option<u32>,
+}
+
+#[derive(Deserialize)]
+struct ScoreArgs {
+    model_file: String,
+    num_results: usize,
+    exclude_file: Option<String>,
+    exclude_key: Option<String>,
+    exclude_docs: Option<Vec<String>>,
+}
+
+#[derive(Deserialize)]
+struct ForgetArgs {
+    exclude_key: String,
+}
+
+#[derive(Deserialize)]
+#[serde(tag = "op", rename_all = "lowercase")]
+enum Request {
+    Train(TrainArgs),
+    Score(ScoreArgs),
+    Forget(ForgetArgs),
+}
+
+struct Stores {
+    // Stores not in use by any request
+    idle: Vec<Store>,
+    // Stores opened so far, idle or not
+    open: usize,
+}
+
+struct State {
+    coll_prefix: String,
+    max_stores: usize,
+    stores: Mutex<Stores>,
+    // Signalled when a Store is checked back in
+    returned: Condvar,
+    // exclude_key -> internal docids to leave out of scoring.  Sets are
+    // shared with any score still running against them, so forgetting
+    // one never pulls it out from under a request.
+    excludes: Mutex<HashMap<String, Arc<HashSet<usize>>>>,
+}
+
+// if we panicked while holding a lock, the lock is poisoned and we have to clean up
+fn lock<T>(mutex: &Mutex<T>) -> MutexGuard<'_, T> {
+    match mutex.lock() {
+        Ok(guard) => guard,
+        Err(poisoned) => poisoned.into_inner(),
+    }
+}
+
+impl State {
+    fn checkout(&self) -> std::io::Result<Store> {
+        let mut stores = lock(&self.stores);
+        loop {
+            if let Some(coll) = stores.idle.pop() {
+                return Ok(coll);
+            }
+            if stores.open < self.max_stores {
+                stores.open += 1;
+                drop(stores);
+                debug!("Opening another Store on {}", self.coll_prefix);
+                let coll = Store::open(&self.coll_prefix);
+                if coll.is_err() {
+                    lock(&self.stores).open -= 1;
+                    self.returned.notify_one();
+                }
+                return coll;
+            }
+            stores = match self.returned.wait(stores) {
+                Ok(guard) => guard,
+                Err(poisoned) => poisoned.into_inner(),
+            };
+        }
+    }
+
+    fn checkin(&self, coll: Store) {
+        lock(&self.stores).idle.push(coll);
+        self.returned.notify_one();
+    }
+}
+
+// A checked-out Store, handed back to the pool when dropped, even if the
+// request panics
+struct CheckedOut<'a> {
+    state: &'a State,
+    coll: Option<Store>,
+}
+
+impl Drop for CheckedOut<'_> {
+    fn drop(&mut self) {
+        if let Some(coll) = self.coll.take() {
+            self.state.checkin(coll);
+        }
+    }
+}
+
+fn main() -> std::io::Result<()> {
+    env_logger::init();
+    let args = Cli::parse();
+    let state = Arc::new(State {
+        stores: Mutex::new(Stores {
+            idle: vec![Store::open(&args.coll_prefix)?],
+            open: 1,
+        }),
+        returned: Condvar::new(),
+        max_stores: args.max_stores.unwrap_or(4).max(1),
+        coll_prefix: args.coll_prefix,
+        excludes: Mutex::new(HashMap::new()),
+    });
+
+    // Clear out a socket left behind by an earlier run
+    if std::fs::exists(&args.socket)? {
+        std::fs::remove_file(&args.socket)?;
+    }
+    let listener = UnixListener::bind(&args.socket)?;
+    debug!("Listening on {}", args.socket);
+
+    for stream in listener.incoming() {
+        let stream = stream?;
+        let state = Arc::clone(&state);
+        thread::spawn(move || {
+            if let Err(e) = serve(stream, &state) {
+                error!("Connection failed: {}", e);
+            }
+        });
+    }
+    Ok(())
+}
+
+fn serve(stream: UnixStream, state: &State) -> std::io::Result<()> {
+    let reader = BufReader::new(stream.try_clone()?);
+    let mut writer = BufWriter::new(stream);
+    for line in reader.lines() {
+        let response = match serde_json::from_str::<Request>(&line?) {
+            Ok(request) => handle(request, state),
+            Err(e) => json!({"ok": false, "error": e.to_string()}),
+        };
+        writeln!(writer, "{}", response)?;
+        writer.flush()?;
+    }
+    Ok(())
+}
+
+fn handle(request: Request, state: &State) -> Value {
+    let result = match request {
+        Request::Train(args) => with_store(state, |coll| train(coll, args)),
+        Request::Score(args) => with_store(state, |coll| score(state, coll, args)),
+        Request::Forget(args) => {
+            lock(&state.excludes).remove(&args.exclude_key);
+            Ok(json!({"ok": true}))
+        }
+    };
+    match result {
+        Ok(response) => response,
+        Err(e) => json!({"ok": false, "error": e.to_string()}),
+    }
+}
+
+fn with_store<F>(state: &State, f: F) -> Result<Value, Box<dyn Error>>
+where
+    F: FnOnce(&mut Store) -> Result<Value, Box<dyn Error>>,
+{
+    let mut checked_out = CheckedOut {
+        state,
+        coll: Some(state.checkout()?),
+    };
+    f(checked_out.coll.as_mut().unwrap())
+}
+
+fn train(coll: &mut Store, args: TrainArgs) -> Result<Value, Box<dyn Error>> {
+    train_qrels(
+        coll,
+        &args.model_file,
+        &args.qrels_file,
+        args.rel_level.unwrap_or(1),
+        args.sample_neg.unwrap_or(0),
+        args.warm_start.as_deref(),
+        args.num_iters,
+    )?;
+    Ok(json!({"ok": true}))
+}
+
+fn score(state: &State, coll: &mut Store, args: ScoreArgs) -> Result<Value, Box<dyn Error>> {
+    let mut new_excludes = Vec::new();
+    for docid in args.exclude_docs.iter().flatten() {
+        new_excludes.push(coll.get_doc_intid(docid)?);
+    }
+    if let Some(efn) = &args.exclude_file {
+        let exclude_fp = BufReader::new(File::open(efn)?);
+        for line in exclude_fp.lines() {
+            if let Some(docid) = line?.split_whitespace().nth(2) {
+                new_excludes.push(coll.get_doc_intid(docid)?);
+            }
+        }
+    }
+    let exclude = match args.exclude_key {
+        Some(key) => {
+            let mut excludes = lock(&state.excludes);
+            let exclude = excludes.entry(key).or_default();
+            Arc::make_mut(exclude).extend(new_excludes);
+            Arc::clone(exclude)
+        }
+        None => Arc::new(new_excludes.into_iter().collect()),
+    };
+
+    let model = Classifier::load(&args.model_file)
+        .map_err(|err| std::io::Error::new(std::io::ErrorKind::Other, err.to_string()))?;
+
+    let rvec = index::score_using_index_excluding(coll, model, &exclude)?;
+
+    let results = rvec.iter().take(args.num_results).collect::<Vec<_>>();
+    Ok(json!({"ok": true, "results": results}))
+}
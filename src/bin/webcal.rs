@@ -50,6 +50,8 @@ struct TrainArgs {
     qrels_file: String,
     rel_level: Option<i32>,
     sample_neg: Option<usize>,
+    warm_start: Option<String>,
+    num_iters: Option<u32>,
 }
 
 #[get("/train")]
@@ -66,6 +68,8 @@ async fn train(state: web::Data<AppState>, query: web::Query<TrainArgs>) -> impl
         &query.qrels_file,
         query.rel_level.unwrap_or(1),
         query.sample_neg.unwrap_or(0),
+        query.warm_start.as_deref(),
+        query.num_iters,
     ) {
         Ok(_classifier) => HttpResponse::Ok().finish(),
         Err(e) => HttpResponseBuilder::new(StatusCode::INTERNAL_SERVER_ERROR).body(e.to_string()),
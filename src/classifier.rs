@@ -141,11 +141,35 @@ impl Classifier {
     const MIN_SCALE: f32 = 0.00000000001;
 
     pub fn train(&mut self, positives: &Vec<FeatureVec>, negatives: &Vec<FeatureVec>) {
+        self.train_iters(positives, negatives, 0, self.num_iters);
+    }
+
+    // Keep training a model that has already had num_iters iterations, for
+    // more_iters more.  The learning rate schedule picks up where it left off,
+    // rather than restarting at a rate that would wipe out the old weights.
+    pub fn train_more(
+        &mut self,
+        positives: &Vec<FeatureVec>,
+        negatives: &Vec<FeatureVec>,
+        more_iters: u32,
+    ) {
+        let start = self.num_iters;
+        self.train_iters(positives, negatives, start, start + more_iters);
+        self.num_iters = start + more_iters;
+    }
+
+    fn train_iters(
+        &mut self,
+        positives: &Vec<FeatureVec>,
+        negatives: &Vec<FeatureVec>,
+        start: u32,
+        end: u32,
+    ) {
         assert!(!positives.is_empty(), "No positive examples");
         assert!(!negatives.is_empty(), "No negative examples");
         let mut rng = rand::rng();
 
-        for i in 0..self.num_iters {
+        for i in start..end {
             let eta = 1.0 / (self.lambda * (i + 1) as f32);
             let a = positives.choose(&mut rng).unwrap();
             let b = negatives.choose(&mut rng).unwrap();
@@ -253,22 +277,48 @@ impl Classifier {
     }
 }
 
+pub const DEFAULT_ITERS: u32 = 200000;
+pub const DEFAULT_WARM_START_ITERS: u32 = 20000;
+
+/*
+Train model_file from the documents in qrels_file.
+If warm_start names a model, training continues from that model's weights
+for num_iters iterations (DEFAULT_WARM_START_ITERS if None); otherwise
+num_iters (DEFAULT_ITERS if None) is the total for a new model.
+*/
 pub fn train_qrels(
     coll: &mut Store,
     model_file: &str,
     qrels_file: &str,
     rel_level: i32,
     num_neg: usize,
+    warm_start: Option<&str>,
+    num_iters: Option<u32>,
 ) -> Result<Classifier, std::io::Error> {
     let model_path = Path::new(model_file);
     let mut model: Classifier;
-    if model_path.exists() {
+    let mut more_iters = None;
+    if let Some(start_file) = warm_start {
+        debug!("Warm-starting model from {}", start_file);
+        if !Path::new(start_file).exists() {
+            return Err(std::io::Error::new(
+                std::io::ErrorKind::NotFound,
+                format!("Could not find warm-start model {}", start_file),
+            ));
+        }
+        model = Classifier::load(start_file)
+            .map_err(|err| std::io::Error::new(std::io::ErrorKind::Other, err.to_string()))?;
+        more_iters = Some(num_iters.unwrap_or(DEFAULT_WARM_START_ITERS));
+    } else if model_path.exists() {
         debug!("Loading model from {}", model_file);
         model = Classifier::load(model_file).unwrap();
+        if let Some(iters) = num_iters {
+            model.num_iters = iters;
+        }
     } else {
         let num_toks = coll.num_features().unwrap();
         debug!("Creating new model of dim {}", num_toks);
-        model = Classifier::new(num_toks, 200000);
+        model = Classifier::new(num_toks, num_iters.unwrap_or(DEFAULT_ITERS));
     }
 
     let qrels = BufReader::new(File::open(qrels_file).expect("Could not open qrels file"));
@@ -325,7 +375,10 @@ pub fn train_qrels(
         });
     }
 
-    model.train(&pos, &neg);
+    match more_iters {
+        Some(iters) => model.train_more(&pos, &neg, iters),
+        None => model.train(&pos, &neg),
+    }
     model.save(model_file)?;
     Ok(model)
 }
@@ -347,7 +347,17 @@ pub fn score_using_index(
         }
         _ => HashSet::new(),
     };
+    score_using_index_excluding(coll, model, &exclude)
+}
 
+// Score like score_using_index, but the documents to skip are given as
+// a set of internal docids.  Callers that score repeatedly against a
+// growing exclude set can keep it around instead of rebuilding it.
+pub fn score_using_index_excluding(
+    coll: &mut Store,
+    model: Classifier,
+    exclude: &HashSet<usize>,
+) -> Result<Vec<DocScore>, Box<dyn std::error::Error>> {
     // Convert the model into a vector of FeaturePairs.
     // The weight vector is in tokid order.
     let mut model_query = model
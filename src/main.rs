@@ -40,6 +40,19 @@ fn cli() -> Command {
                         .value_parser(clap::value_parser!(i32))
                         .default_value("1")
                         .help("Minimum relevance level in the qrels to count as relevant."),
+                )
+                .arg(
+                    Arg::new("warm_start")
+                        .short('w')
+                        .long("warm-start")
+                        .help("Continue training from this model instead of starting fresh"),
+                )
+                .arg(
+                    Arg::new("iterations")
+                        .short('i')
+                        .long("iterations")
+                        .value_parser(clap::value_parser!(u32))
+                        .help("Number of training iterations (default 200000, or 20000 when warm-starting)"),
                 ),
         )
         .subcommand(
@@ -83,8 +96,18 @@ fn main() -> Result<(), Box<dyn Error>> {
             let qrels_file = qrels_args.get_one::<String>("qrels_file").unwrap();
             let rel_level = qrels_args.get_one::<i32>("level").unwrap();
             let num_neg = qrels_args.get_one::<usize>("negatives").unwrap();
+            let warm_start = qrels_args.get_one::<String>("warm_start");
+            let num_iters = qrels_args.get_one::<u32>("iterations");
             let mut coll = Store::open(&coll_prefix)?;
-            train_qrels(&mut coll, model_file, qrels_file, *rel_level, *num_neg)?;
+            train_qrels(
+                &mut coll,
+                model_file,
+                qrels_file,
+                *rel_level,
+                *num_neg,
+                warm_start.map(|s| s.as_str()),
+                num_iters.copied(),
+            )?;
         }
         Some(("score", score_args)) => {
             score_collection(coll_prefix, model_file, score_args)?;
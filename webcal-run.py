@@ -5,11 +5,13 @@ import subprocess
 import sys
 import argparse
 import logging
+import random
 import os
 import fcntl
 import requests
+from requests.adapters import HTTPAdapter
 
-logging.basicConfig(format='%(levelname)s %(msg)s',
+logging.basicConfig(format='%(levelname)s %(message)s',
                     level=logging.INFO)
 
 ap = argparse.ArgumentParser(
@@ -30,6 +32,14 @@ ap.add_argument('-n', '--num_docs',
                 default=1,
                 type=int,
                 help='Number of documents to score at each round')
+ap.add_argument('-S', '--pool-sample',
+                default=None,
+                type=int,
+                help='Train initially on a uniform sample of this many pool documents, None for all')
+ap.add_argument('--seed',
+                default=None,
+                type=int,
+                help='Random seed for --pool-sample, None to seed from the system')
 ap.add_argument('-s', '--max_steps',
                 default=None,
                 type=int,
@@ -41,6 +51,13 @@ ap.add_argument('-z', '--zero-steps',
                 default=None,
                 type=int,
                 help='Number of steps without a relevant document to do before stopping')
+ap.add_argument('-w', '--warm-start',
+                action='store_true',
+                help='Train each step by continuing from the last model instead of from scratch')
+ap.add_argument('-i', '--iterations',
+                default=None,
+                type=int,
+                help='Training iterations for each warm-started step, None for the MyCal default')
 ap.add_argument('-r', '--relstop',
                 help='Stop when all relevant documents are found',
                 action='store_false')
@@ -52,8 +69,13 @@ ap.add_argument('qrels',
                 help='Relevance judgments for training and test')
 
 args = ap.parse_args()
+if args.pool_sample is not None and args.pool_sample < 1:
+    ap.error('--pool-sample must be at least 1')
 TRAIN_URL = f'http://{args.host}:{args.port}/train'
 SCORE_URL = f'http://{args.host}:{args.port}/score'
+# One HTTP session for the whole run, so requests reuse a kept-alive connection to webcal
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
 
 class Lock:
     def __init__(self, filename):
@@ -63,16 +85,18 @@ class Lock:
     def acquire(self):
         if args.disable_locking:
             return
-        self.file = open(self.filename, 'w')
-        self.file = open(self.filename, 'w')
-        print(os.getpid(), file=self.file)
-        fcntl.flock(self.file, fcntl.LOCK_EX)
+        # Open without truncating so we don't wipe the holder's pid while we wait.
+        # lockf gives POSIX record locks, which work over NFS where flock may not.
+        self.file = open(self.filename, 'a')
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        self.file.truncate(0)
+        print(os.getpid(), file=self.file, flush=True)
     
     def release(self):
         if args.disable_locking:
             return
         if self.file:
-            fcntl.flock(self.file, fcntl.LOCK_UN)
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
             self.file.close()
             self.file = None
 
@@ -80,7 +104,7 @@ class Lock:
         self.acquire()
         return self
     
-    def __exit__(self):
+    def __exit__(self, exc_type, exc, tb):
         self.release()
 
 @contextmanager
@@ -92,40 +116,59 @@ def locked(filename):
     finally:
         lock.release()
 
+def topic_lines(filename, topics):
+    # Read the lines of a qrels or pool file for the given topics, as bytes.
+    # Lines for other topics are rejected on their prefix without being split.
+    prefixes = tuple(f'{topic}{sep}'.encode() for topic in topics for sep in ' \t')
+    with open(filename, 'rb') as topic_file:
+        return [line for line in topic_file.read().splitlines() if line.startswith(prefixes)]
+
+# Docids are interned so that qrels, pool and training data share one string per document
 qrels = {}
-with open(args.qrels, 'r') as qrels_file:
-    for line in qrels_file:
-        topic, _, docid, rel = line.split()
-        if topic != args.topic:
-            continue
-        qrels[docid] = int(rel)
+for line in topic_lines(args.qrels, [args.topic]):
+    _, _, docid, rel = line.split()
+    qrels[sys.intern(docid.decode())] = int(rel)
 num_rel = sum(1 for v in qrels.values() if v > 0)
 rel_seen = 0
 docs_reviewed = 0
 rel_seen_after_training = 0
+# The training data so far, docid -> rel
+train = {}
 
 def do_initial_training():
     global rel_seen, docs_reviewed
     training_qrels = f'{args.topic}.train.0'
     output_model = f'{args.topic}.model.0'
+    # Reservoir-sample the pool if asked to (Algorithm R), with --seed if given
+    rng = random.Random(args.seed)
+    sample = []
+    num_eligible = 0
+    # Ranks are compared as digit strings rather than converted: a shorter
+    # number is smaller, and numbers of the same length compare bytewise
+    max_rank = str(args.train_rank).encode()
+    max_rank_len = len(max_rank)
+    for line in topic_lines(args.pool, [args.topic]):
+        _, docid, rank, _ = line.split(maxsplit=3)
+        if len(rank) > max_rank_len or (len(rank) == max_rank_len and rank > max_rank):
+            continue
+        num_eligible += 1
+        if args.pool_sample is None or len(sample) < args.pool_sample:
+            sample.append(sys.intern(docid.decode()))
+        else:
+            slot = rng.randrange(num_eligible)
+            if slot < args.pool_sample:
+                sample[slot] = sys.intern(docid.decode())
+
     with open(training_qrels, 'w') as train_file:
-        with open(args.pool, 'r') as pool_file:
-            for line in pool_file:
-                topic, docid, rank, _ = line.split(maxsplit=3)
-                if topic != args.topic:
-                    continue
-                if int(rank) > args.train_rank:
-                    continue
-                docs_reviewed += 1
-                if docid in qrels:
-                    rel = qrels[docid]
-                    if rel > 0:
-                        rel_seen += 1
-                else:
-                    rel = 0
-                print(f'{topic} 0 {docid} {rel}', file=train_file)
-
-    resp = requests.get(TRAIN_URL, params={'model_file': f'{args.topic}.model.0', 'qrels_file': f'{args.topic}.train.0'})
+        for docid in sample:
+            docs_reviewed += 1
+            rel = qrels.get(docid, 0)
+            if rel > 0:
+                rel_seen += 1
+            train[docid] = rel
+            print(f'{args.topic} 0 {docid} {rel}', file=train_file)
+
+    resp = session.get(TRAIN_URL, params={'model_file': f'{args.topic}.model.0', 'qrels_file': f'{args.topic}.train.0'})
     if resp.status_code != 200:
         logging.critical(f'Failed to train model: {resp.text}')
         sys.exit(-1)
@@ -142,56 +185,51 @@ def one_step(step):
         logging.critical(f'Bad step value {step}')
         sys.exit(-1)
 
-    # get last training data
-    train = {}
-    with open(f'{args.topic}.train.{last_step}', 'r') as train_file:
-        for line in train_file:
-            topic, _, docid, rel = line.split()
-            if topic != args.topic:
-                logging.critical('Bad training file, wrong topic')
-                sys.exit(-1)
-            train[docid] = rel
-        
     # Score collection
-    resp = requests.get(SCORE_URL, params={'model_file': f'{args.topic}.model.{last_step}',
-                                           'num_results': args.num_docs,
-                                           'exclude_file': f'{args.topic}.train.{last_step}'
-                                           })
+    resp = session.get(SCORE_URL, params={'model_file': f'{args.topic}.model.{last_step}',
+                                          'num_results': args.num_docs,
+                                          'exclude_file': f'{args.topic}.train.{last_step}'
+                                          })
     if resp.status_code != 200:
         logging.critical(f'Failed to score collection: {resp.text}')
         sys.exit(-1)
+    docids = [sys.intern(entry['docid']) for entry in resp.json()]
 
-    # Add judgments to training data
-    rel_seen_this_step = 0
-    for entry in resp.json():
-        docid = entry['docid']
-        score = entry['score']
-        if docid in train:
-            logging.critical(f'Scored document {docid} already in training data')
-            sys.exit(-1)
-        docs_reviewed += 1
-        if docid in qrels:
-            rel = qrels[docid]
-            if rel > 0:
-                rel_seen += 1
-                rel_seen_this_step += 1
-                rel_seen_after_training += 1
-                zero_steps = 0
-        else:
-            rel = 0
-        logging.debug(f'Adding {docid} to training')
-        train[docid] = rel
-        
-    if rel_seen_this_step == 0:
+    # Add judgments to training data, a whole batch at a time.  A docid
+    # repeated within the batch is as bad as one already trained on.
+    if len(set(docids)) != len(docids) or not train.keys().isdisjoint(docids):
+        seen = set()
+        for docid in docids:
+            if docid in train or docid in seen:
+                logging.critical(f'Scored document {docid} already in training data')
+                sys.exit(-1)
+            seen.add(docid)
+    # Most scored documents are unjudged, so look them up with a single probe
+    rels = [qrels.get(docid, 0) for docid in docids]
+    rel_seen_this_step = sum(1 for rel in rels if rel > 0)
+    docs_reviewed += len(docids)
+    rel_seen += rel_seen_this_step
+    rel_seen_after_training += rel_seen_this_step
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Adding %s to training', ' '.join(docids))
+    train.update(zip(docids, rels))
+
+    if rel_seen_this_step > 0:
+        zero_steps = 0
+    else:
         zero_steps += 1
         
     # Write new training data
     with open(f'{args.topic}.train.{step}', 'w') as train_file:
-        for docid, rel in train.items():
-            print(args.topic, 0, docid, rel, file=train_file)
+        train_file.writelines([f'{args.topic} 0 {docid} {rel}\n' for docid, rel in train.items()])
 
     # Train new model
-    resp = requests.get(TRAIN_URL, params={'model_file': f'{args.topic}.model.{step}', 'qrels_file': f'{args.topic}.train.{step}'})
+    params = {'model_file': f'{args.topic}.model.{step}', 'qrels_file': f'{args.topic}.train.{step}'}
+    if args.warm_start:
+        params['warm_start'] = f'{args.topic}.model.{last_step}'
+        if args.iterations:
+            params['num_iters'] = args.iterations
+    resp = session.get(TRAIN_URL, params=params)
     if resp.status_code != 200:
         logging.critical(f'Failed to train model at step {step}: {resp.text}')
         sys.exit(-1)
@@ -231,5 +269,3 @@ if __name__ == '__main__':
         if args.zero_steps and zero_steps > args.zero_steps:
             logging.info(f'{zero_steps} steps with no new relevant found, stopping')
             break
-        
-        